@@ -1,12 +1,14 @@
 import socket
+from udp_tuning import tune_udp_socket
 
-def receive_udp_data(ip_address="0.0.0.0", port=6002):
+def receive_udp_data(ip_address="0.0.0.0", port=6002, rcvbuf_bytes=12*1024*1024):
     """
     Receive UDP data from a specific IP address on the given port.
     
     Parameters:
     - ip_address: The IP address to listen on (default "0.0.0.0" means all available interfaces)ø
     - port: The port to listen on (default 5005)
+    - rcvbuf_bytes: Kernel receive buffer size requested for the socket
     """
     # Create a UDP socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -16,17 +18,25 @@ def receive_udp_data(ip_address="0.0.0.0", port=6002):
     print(f"Starting UDP server on {ip_address}:{port}")
     sock.bind(server_address)
     
+    # Enlarge the kernel receive buffer so bursts are not dropped
+    tune_udp_socket(sock, rcvbuf_bytes)
+    
+    # Preallocated receive buffer, reused for every datagram
+    rxbuf = bytearray(4096)
+    rxview = memoryview(rxbuf)
+    
     try:
         while True:
-            # Receive data
+            # Receive data straight into the buffer
             print("\nWaiting to receive message...")
-            data, address = sock.recvfrom(4096)
+            nbytes, address = sock.recvfrom_into(rxbuf)
+            data = rxview[:nbytes]
             
-            print(f"Received {len(data)} bytes from {address}")
-            print(f"Data: {data.decode('utf-8', errors='replace')}")
+            print(f"Received {nbytes} bytes from {address}")
+            print(f"Data: {str(data, 'utf-8', errors='replace')}")
             
             # Optionally, you can also print data as bytes or hex
-            print(f"Raw data: {data}")
+            print(f"Raw data: {data.tobytes()}")
             print(f"Hex data: {data.hex()}")
             
     except KeyboardInterrupt:
@@ -1,18 +1,45 @@
 import socket
+import os
 import struct
 import numpy as np
 import pyaudio
 import argparse
+import math
 import time
 import threading
-import queue
 import sys
+from udp_tuning import tune_udp_socket
+
+# SO_BUSY_POLL from the generic Linux socket.h, not exported by the socket module
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)
+
+def make_thread_realtime(name, cpu, priority):
+    """
+    Pin the calling thread to one CPU and give it SCHED_FIFO priority where
+    the platform and permissions allow, otherwise leave it unchanged
+    """
+    # On Linux pid 0 means the calling thread, not the whole process
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, {cpu})
+            print(f"{name} thread pinned to CPU {cpu}")
+        except OSError as e:
+            print(f"Could not pin {name} thread to CPU {cpu}: {e}")
+    if hasattr(os, 'sched_setscheduler'):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+            print(f"{name} thread running SCHED_FIFO priority {priority}")
+        except OSError as e:
+            # Needs root or CAP_SYS_NICE
+            print(f"Could not set realtime priority for {name} thread: {e}")
 
 #code for testing
 #simple audio streaming
-def receive_and_play(listen_port=6001, stm32_ip="192.168.1.111", 
+def receive_and_play(listen_port=6001, stm32_ip="192.168.1.111", stm32_port=0,
                      sample_rate=32018, buffer_size=4048,
-                     jitter_buffer_ms=100, use_big_endian=True):
+                     jitter_buffer_ms=100, use_big_endian=False,
+                     rcvbuf_bytes=12*1024*1024, realtime=False,
+                     adaptive_jitter=False, busy_poll_us=0):
     """
     Simplified but reliable UDP audio player with anti-crackling measures
     """
@@ -21,88 +48,161 @@ def receive_and_play(listen_port=6001, stm32_ip="192.168.1.111",
     print(f"Sample rate: {sample_rate} Hz")
     print(f"Buffer size: {buffer_size} samples")
     print(f"Jitter buffer: {jitter_buffer_ms} ms")
+    print(f"Socket receive buffer: {rcvbuf_bytes} bytes")
     print("=====================\n")
     
-    # Socket setup with enlarged buffer
+    # Socket setup, enlarging the kernel buffer right after bind
     udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 262144)
     udp_sock.bind(("0.0.0.0", listen_port))
+    tune_udp_socket(udp_sock, rcvbuf_bytes)
     udp_sock.settimeout(0.1)
     
+    # Optional busy polling: the kernel spins on the NIC queue for up to
+    # busy_poll_us inside a read before sleeping (Linux only, raising it above
+    # net.core.busy_read needs CAP_NET_ADMIN). It only spins in a blocking
+    # read, while settimeout() makes the socket non-blocking and waits in
+    # poll(), so the 0.1 s timeout moves into the kernel as SO_RCVTIMEO
+    if busy_poll_us and sys.platform.startswith('linux'):
+        try:
+            udp_sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, busy_poll_us)
+            udp_sock.settimeout(None)
+            udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO,
+                                struct.pack('ll', 0, 100000))
+        except OSError as e:
+            print(f"Could not enable busy polling: {e}")
+    
+    # Connecting to the STM32 makes the kernel drop datagrams from any other
+    # sender before they reach user space. It also narrows the 0.0.0.0 bind
+    # to the one local address on the route to the STM32, so packets sent to
+    # another local address, a second interface or broadcast are lost. Only
+    # do it when a source port is given; otherwise filter by address below
+    kernel_filtered = False
+    if stm32_port:
+        try:
+            udp_sock.connect((stm32_ip, stm32_port))
+            kernel_filtered = True
+        except OSError as e:
+            print(f"Could not filter by sender in the kernel: {e}")
+    
     # Calculate jitter buffer in packets
     jitter_packets = int((jitter_buffer_ms / 1000) * sample_rate / buffer_size) + 5
     
-    # Audio queue with ample capacity
-    audio_queue = queue.Queue(maxsize=jitter_packets * 3)
+    # Lock-free single-producer/single-consumer ring of packets with ample
+    # capacity. Only the receiver advances head and only the playback thread
+    # advances tail; a slot is filled before head is bumped to publish it.
+    ring_size = jitter_packets * 3
+    ring = [None] * ring_size
+    head = 0
+    tail = 0
     
     # Control flags
-    running = True
-    buffer_ready = False
+    stop = threading.Event()
+    buffer_ready = threading.Event()
+    # Set by the receiver after publishing a packet, cleared by playback
+    # only when the ring runs empty, so the per-packet path stays lock-free
+    data_ready = threading.Event()
+    
+    # Playback target depth in packets. With adaptive jitter the receiver
+    # retunes it from measured arrival jitter and playback sheds the excess
+    buffer_target = jitter_packets // 2
     
     # Initialize statistics
     packets_received = 0
+    packets_dropped = 0
+    packets_trimmed = 0
     start_time = time.time()
     
+    # Separate cores for playback and receive when realtime mode is enabled
+    playback_cpu = receiver_cpu = None
+    if realtime and hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) >= 2:
+            playback_cpu, receiver_cpu = cpus[-1], cpus[-2]
+    
     # Initialize PyAudio
     p = pyaudio.PyAudio()
     stream = None  # Will be created later
     
     def receive_thread_func():
-        nonlocal packets_received, buffer_ready
+        nonlocal head, packets_received, packets_dropped, buffer_target
+        
+        # Smoothed inter-arrival jitter in seconds (RFC 3550 style estimator)
+        jitter = 0.0
+        last_arrival = None
+        next_retarget = time.monotonic() + 1.0
+        
+        if realtime:
+            make_thread_realtime("Receiver", receiver_cpu, 10)
         
         print(f"Waiting for audio from {stm32_ip}...")
         
         try:
-            while running:
+            while not stop.is_set():
                 try:
                     # Receive UDP packet
-                    data, addr = udp_sock.recvfrom(8192)
-                    
-                    # Only accept packets from STM32
-                    if addr[0] != stm32_ip:
-                        continue
+                    if kernel_filtered:
+                        data = udp_sock.recv(8192)
+                    else:
+                        data, addr = udp_sock.recvfrom(8192)
+                        
+                        # Only accept packets from STM32
+                        if addr[0] != stm32_ip:
+                            continue
                     
                     # First packet info
                     if packets_received == 0:
                         print(f"First packet received: {len(data)} bytes")
-                        # For big-endian data:
-                        #samples = np.frombuffer(data, dtype='>i2')
-                        # OR for little-endian data:
-                        #samples = np.frombuffer(data, dtype='<i2')
-                        samples = np.frombuffer(data, dtype=np.int16)
-                        # Swap bytes
-                        samples_swapped = samples.byteswap()
-                        # Convert back to bytes for audio playback
-                        audio_data_swapped = samples_swapped.tobytes()
-                        print(f"First few samples: {audio_data_swapped[:5]}")
+                        # View just the leading samples instead of decoding
+                        # and byte-swapping the whole packet
+                        first = np.frombuffer(data, dtype='<i2', count=min(4, len(data) // 2))
+                        # Show both byte orders and the one in use, to help
+                        # decide whether --big-endian is needed
+                        print(f"First few samples: little-endian {first.tolist()}, "
+                              f"big-endian {first.byteswap().tolist()} "
+                              f"(playing as {'big' if use_big_endian else 'little'}-endian)")
                     
-                    # Add to queue
-                    try:
-                        audio_queue.put(data, block=False)
-                    except queue.Full:
-                        # If queue is full, remove oldest packet
-                        try:
-                            audio_queue.get_nowait()
-                            audio_queue.put_nowait(data)
-                        except:
-                            pass
+                    # Add to ring. The tail belongs to the playback thread,
+                    # so when the ring is full the new packet is dropped
+                    if head - tail < ring_size:
+                        ring[head % ring_size] = data
+                        head += 1
+                        if not data_ready.is_set():
+                            data_ready.set()
+                    else:
+                        packets_dropped += 1
                     
                     packets_received += 1
                     
+                    # Track arrival jitter and retune the target once a second
+                    if adaptive_jitter and data:
+                        now = time.monotonic()
+                        packet_duration = len(data) / 2 / sample_rate
+                        if last_arrival is not None:
+                            deviation = abs((now - last_arrival) - packet_duration)
+                            jitter += (deviation - jitter) / 16
+                            if now >= next_retarget:
+                                buffer_target = max(2, math.ceil(3 * jitter / packet_duration))
+                                next_retarget = now + 1.0
+                        last_arrival = now
+                    
                     # Fill initial buffer before starting playback
-                    if not buffer_ready and audio_queue.qsize() >= jitter_packets // 2:
-                        print(f"Buffer ready with {audio_queue.qsize()} packets. Starting playback...")
-                        buffer_ready = True
+                    if not buffer_ready.is_set() and head - tail >= jitter_packets // 2:
+                        print(f"Buffer ready with {head - tail} packets. Starting playback...")
+                        buffer_ready.set()
                     
                     # Print stats periodically
                     if packets_received % 500 == 0:
                         elapsed = time.time() - start_time
                         rate = packets_received / elapsed if elapsed > 0 else 0
                         print(f"Received {packets_received} packets in {elapsed:.1f}s ({rate:.1f}/s)")
-                        print(f"Buffer status: {audio_queue.qsize()}/{audio_queue.maxsize}")
+                        print(f"Buffer status: {head - tail}/{ring_size} ({packets_dropped} dropped)")
+                        if adaptive_jitter:
+                            print(f"Jitter: {jitter * 1000:.1f} ms, target {buffer_target} packets "
+                                  f"({packets_trimmed} trimmed)")
                 
-                except socket.timeout:
-                    # Just a timeout, continue
+                except (socket.timeout, BlockingIOError):
+                    # Just a timeout (BlockingIOError from SO_RCVTIMEO when
+                    # busy polling), continue
                     continue
                     
             print("Receiver thread stopping...")
@@ -111,14 +211,17 @@ def receive_and_play(listen_port=6001, stm32_ip="192.168.1.111",
             print(f"Receiver error: {e}")
     
     def playback_thread_func():
-        nonlocal stream
+        nonlocal stream, tail, packets_trimmed
+        
+        if realtime:
+            make_thread_realtime("Playback", playback_cpu, 20)
         
-        # Wait for buffer to fill initially
+        # Wait for buffer to fill initially; the receiver sets the event
+        # when it is full and shutdown sets it to release the wait
         print("Waiting for buffer to fill...")
-        while running and not buffer_ready:
-            time.sleep(0.1)
+        buffer_ready.wait()
         
-        if not running:
+        if stop.is_set():
             return
             
         # Create audio stream once buffer is ready
@@ -131,42 +234,72 @@ def receive_and_play(listen_port=6001, stm32_ip="192.168.1.111",
         print("Starting audio playback")
         silence_counter = 0
         
-        # Specify which endianness to use
-        use_big_endian = False  # Set to True for big endian, False for little endian
+        # One block of 16-bit silence, allocated once rather than per gap
+        silence = bytes(buffer_size * 2)
+        
+        # Byte order is fixed for the whole stream, so decide once from the
+        # configured order whether packets have to be swapped before playback
+        needs_swap = use_big_endian != (sys.byteorder == 'big')
+        
+        # Shed at most one packet per interval so latency shrinks gradually
+        next_trim = 0.0
+        
+        # Upper bounds for one coalesced stream write
+        max_batch = 4
+        max_write_bytes = max_batch * buffer_size * 2
         
         try:
-            while running:
-                try:
-                    # Get data from queue with short timeout
-                    audio_data = audio_queue.get(timeout=0.1)
-                    silence_counter = 0
-                    
-                    # Convert to samples, swap if needed, then back to bytes
-                    samples = np.frombuffer(audio_data, dtype=np.int16)
-                    
-                    # Handle endianness - swap if needed
-                    if use_big_endian and sys.byteorder == 'little':
-                        # Convert little to big endian
-                        samples = samples.byteswap()
-                    elif not use_big_endian and sys.byteorder == 'big':
-                        # Convert big to little endian
-                        samples = samples.byteswap()
-                    
-                    # Convert back to bytes for playback
-                    audio_data_corrected = samples.tobytes()
-                    
-                    # Write to audio stream
-                    stream.write(audio_data_corrected)
-                    
-                except queue.Empty:
-                    # Queue is empty, insert small amount of silence
+            while not stop.is_set():
+                if tail == head:
+                    # Ring is empty, sleep until the receiver publishes a
+                    # packet or the grace period ends. Clear before checking
+                    # again so a packet published in between is not missed
+                    data_ready.clear()
+                    if tail == head:
+                        data_ready.wait(timeout=0.1)
+                
+                if tail == head:
+                    # Still empty, insert small amount of silence. After
+                    # several silence blocks just keep waiting for more data
                     silence_counter += 1
                     if silence_counter < 5:
-                        silence = np.zeros(buffer_size, dtype=np.int16).tobytes()
                         stream.write(silence)
-                    else:
-                        # After several silence blocks, wait for more data
-                        time.sleep(0.01)
+                    continue
+                
+                # Skip the oldest packet when the ring holds well over target.
+                # Depth swings by up to one batch while a coalesced write
+                # plays, so that much is allowed on top of the target
+                if adaptive_jitter and head - tail > buffer_target + max_batch + 2:
+                    now = time.monotonic()
+                    if now >= next_trim:
+                        tail += 1
+                        packets_trimmed += 1
+                        next_trim = now + 0.5
+                        continue
+                
+                # Coalesce up to max_batch ready packets into one write. A
+                # single packet goes to the stream as received, without a copy
+                chunks = []
+                total = 0
+                for i in range(min(head - tail, max_batch)):
+                    data = ring[(tail + i) % ring_size]
+                    if chunks and total + len(data) > max_write_bytes:
+                        break
+                    chunks.append(data)
+                    total += len(data)
+                audio_data = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+                tail += len(chunks)
+                
+                # Handle endianness - only swapped audio is copied again,
+                # native-order audio is written as is
+                if needs_swap:
+                    samples = np.frombuffer(audio_data, dtype=np.int16, count=total // 2)
+                    audio_data = samples.byteswap().tobytes()
+                
+                silence_counter = 0
+                
+                # Write to audio stream
+                stream.write(audio_data)
         except Exception as e:
             print(f"Playback error: {e}")
         finally:
@@ -189,33 +322,56 @@ def receive_and_play(listen_port=6001, stm32_ip="192.168.1.111",
     except KeyboardInterrupt:
         print("\nStopping audio playback...")
     finally:
-        # Clean up
-        running = False
-        time.sleep(0.5)
+        # Clean up. The receiver wakes within its 0.1 s socket timeout and
+        # playback within one stream write, so wait for both to finish
+        # before closing what they use
+        stop.set()
+        buffer_ready.set()
+        data_ready.set()
+        receiver_thread.join(timeout=1.0)
+        playback_thread.join(timeout=1.0)
         
-        if stream:
-            stream.stop_stream()
-            stream.close()
+        # A write blocked on a stalled device can outlast the join. Closing
+        # the stream under it is unsafe, so leave PyAudio to process exit
+        if playback_thread.is_alive():
+            print("Playback thread still busy, leaving the audio device open")
+        else:
+            if stream:
+                stream.stop_stream()
+                stream.close()
+            p.terminate()
         
-        p.terminate()
-        udp_sock.close()
+        if receiver_thread.is_alive():
+            print("Receiver thread still busy, leaving the socket open")
+        else:
+            udp_sock.close()
         print("Audio player stopped")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Simple Reliable Audio Player')
     parser.add_argument('--port', type=int, default=6001, help='UDP listen port')
     parser.add_argument('--stm32', type=str, default='192.168.1.111', help='STM32 IP address')
+    parser.add_argument('--stm32-port', type=int, default=0, help='STM32 source port, filters senders in the kernel but also pins the local receive address to the route to the STM32 (0 = filter by address only)')
     parser.add_argument('--rate', type=int, default=32018, help='Audio sample rate (Hz)')
     parser.add_argument('--buffer', type=int, default=1024, help='Audio buffer size (samples)')
     parser.add_argument('--jitter', type=int, default=100, help='Jitter buffer size (ms)')
     parser.add_argument('--big-endian', action='store_true', help='Set if STM32 is sending big-endian data')
-args = parser.parse_args()
-    
-receive_and_play(
-    listen_port=args.port,
-    stm32_ip=args.stm32,
-    sample_rate=args.rate,
-    buffer_size=args.buffer,
-    jitter_buffer_ms=args.jitter,
-    use_big_endian=args.big_endian
-)
+    parser.add_argument('--rcvbuf', type=int, default=12*1024*1024, help='Socket receive buffer size (bytes)')
+    parser.add_argument('--adaptive-jitter', action='store_true', help='Shrink the jitter buffer to the measured network jitter')
+    parser.add_argument('--busy-poll', type=int, default=0, help='Busy-poll inside each socket read for up to this many microseconds (Linux, needs CAP_NET_ADMIN above net.core.busy_read, 0 = off)')
+    parser.add_argument('--realtime', action='store_true', help='Pin threads to separate CPUs with SCHED_FIFO priority (needs root or CAP_SYS_NICE)')
+    args = parser.parse_args()
+    
+    receive_and_play(
+        listen_port=args.port,
+        stm32_ip=args.stm32,
+        stm32_port=args.stm32_port,
+        sample_rate=args.rate,
+        buffer_size=args.buffer,
+        jitter_buffer_ms=args.jitter,
+        use_big_endian=args.big_endian,
+        rcvbuf_bytes=args.rcvbuf,
+        realtime=args.realtime,
+        adaptive_jitter=args.adaptive_jitter,
+        busy_poll_us=args.busy_poll
+    )
@@ -0,0 +1,31 @@
+import socket
+import sys
+
+def tune_udp_socket(sock, target=12*1024*1024):
+    """
+    Request a large kernel receive buffer and report what was actually granted
+    """
+    # macOS and the BSDs reject a request above kern.ipc.maxsockbuf with
+    # ENOBUFS instead of capping it (FreeBSD allows only 2 MiB by default),
+    # so halve the request until it is accepted
+    requested = target
+    while True:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, requested)
+            break
+        except OSError as e:
+            if requested <= 64*1024:
+                print(f"Warning: could not enlarge socket receive buffer: {e}")
+                break
+            requested //= 2
+    
+    # Linux silently caps the request at net.core.rmem_max and reports double
+    # the usable size, so halve the readback before comparing
+    actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if sys.platform.startswith('linux'):
+        actual //= 2
+    if actual < target:
+        print(f"Warning: socket receive buffer capped at {actual} bytes "
+              f"(requested {target}), raise net.core.rmem_max "
+              f"(kern.ipc.maxsockbuf on macOS/BSD) to allow more")
+    return actual